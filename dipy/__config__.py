@@ -0,0 +1,4 @@
+# Automatically generated; do not edit
+# Variables from compile checks
+USING_GCC_SSE2 = True
+HAVE_OPENMP = True
@@ -1,10 +1,12 @@
 """ Classes and functions for fitting ivim model """
 
 from distutils.version import LooseVersion
+from multiprocessing import cpu_count, Pool
 import numpy as np
 from scipy.optimize import least_squares, differential_evolution
 import warnings
 from dipy.reconst.base import ReconstModel
+from dipy.reconst.ivimspeed import ivim_signal, IvimResidual
 from dipy.reconst.multi_voxel import multi_voxel_fit
 from dipy.utils.optpkg import optional_package
 cvxpy, have_cvxpy, _ = optional_package("cvxpy")
@@ -19,8 +21,11 @@ def ivim_prediction(params, gtab):
 
     Parameters
     ----------
-    params : array
-        An array of IVIM parameters - [S0, f, D_star, D].
+    params : array (..., 4)
+        An array of IVIM parameters - [S0, f, D_star, D]. The last dimension
+        holds the parameters, all other dimensions are treated as voxels.
+        Arrays with the parameters along the first dimension, (4, ...), are
+        not supported anymore: use ``np.moveaxis(params, 0, -1)``.
 
     gtab : GradientTable class instance
         Gradient directions and bvalues.
@@ -32,16 +37,20 @@ def ivim_prediction(params, gtab):
 
     Returns
     -------
-    S : array
+    S : array (..., len(bvals))
         An array containing the IVIM signal estimated using given parameters.
 
     """
-    b = gtab.bvals
-    S0, f, D_star, D = params
+    params = np.asarray(params)
+    if params.ndim == 0 or params.shape[-1] != 4:
+        e_s = "The IVIM parameters should be given along the last dimension "
+        e_s += "of params, with shape (..., 4), but params has shape "
+        e_s += "%s" % (params.shape,)
+        raise ValueError(e_s)
+    # The signal is computed in a single pass over the bvalues of each voxel
+    S = ivim_signal(params.reshape(-1, 4), gtab.bvals)
 
-    S = S0 * (f * np.exp(-b * D_star) + (1 - f) * np.exp(-b * D))
-
-    return S
+    return S.reshape(params.shape[:-1] + (-1,))
 
 
 def _ivim_error(params, gtab, signal):
@@ -68,22 +77,47 @@ def _ivim_error(params, gtab, signal):
     return residual
 
 
+def _ivim_jac(params, gtab, signal):
+    """Jacobian of the error function used in fitting the IVIM model.
+
+    Parameters
+    ----------
+    params : array
+        An array of IVIM parameters - [S0, f, D_star, D]
+
+    gtab : GradientTable class instance
+        Gradient directions and bvalues.
+
+    signal : array
+        Array containing the actual signal values.
+
+    Returns
+    -------
+    jac : array (len(bvals), 4)
+        The derivatives of the residual returned by `_ivim_error` with
+        respect to S0, f, D_star and D.
+
+    """
+    return IvimResidual(gtab.bvals, signal).jacobian(
+        np.asarray(params, dtype=float))
+
+
 def f_D_star_prediction(params, gtab, S0, D):
     """Function used to predict IVIM signal when S0 and D are known
     by considering f and D_star as the unknown parameters.
 
     Parameters
     ----------
-    params : array
+    params : array (..., 2)
         The value of f and D_star.
 
     gtab : GradientTable class instance
         Gradient directions and bvalues.
 
-    S0 : float
+    S0 : float or array
         The parameters S0 obtained from a linear fit.
 
-    D : float
+    D : float or array
         The parameters D obtained from a linear fit.
 
     Returns
@@ -92,10 +126,13 @@ def f_D_star_prediction(params, gtab, S0, D):
         An array containing the IVIM signal estimated using given parameters.
 
     """
-    f, D_star = params
-    b = gtab.bvals
-    S = S0 * (f * np.exp(-b * D_star) + (1 - f) * np.exp(-b * D))
-    return S
+    params = np.asarray(params)
+    S0, f, D_star, D = np.broadcast_arrays(S0, params[..., 0],
+                                           params[..., 1], D)
+    # The signal is computed in a single pass over the bvalues of each voxel
+    ivim_params = np.stack([S0, f, D_star, D], axis=-1)
+    S = ivim_signal(ivim_params.reshape(-1, 4), gtab.bvals)
+    return S.reshape(S0.shape + (-1,))
 
 
 def f_D_star_error(params, gtab, signal, S0, D):
@@ -124,8 +161,52 @@ def f_D_star_error(params, gtab, signal, S0, D):
         An array containing the difference of actual and estimated signal.
 
     """
+    return signal - f_D_star_prediction(params, gtab, S0, D)
+
+
+def _f_D_star_residual(params, neg_bvals, signal_D, S0, exp_D):
+    """Error function used to fit f and D_star keeping S0 and D fixed.
+
+    Parameters
+    ----------
+    params : array
+        The value of f and D_star.
+
+    neg_bvals : array
+        The bvalues with their signs flipped.
+
+    signal_D : array
+        The actual signal values minus S0 * exp(-b * D).
+
+    S0 : float
+        The parameters S0 obtained from a linear fit.
+
+    exp_D : array
+        The values of exp(-b * D), with D obtained from a linear fit.
+
+    Returns
+    -------
+    residual : array
+        An array containing the difference of actual and estimated signal.
+    """
     f, D_star = params
-    return signal - f_D_star_prediction([f, D_star], gtab, S0, D)
+    return signal_D - f * S0 * (np.exp(neg_bvals * D_star) - exp_D)
+
+
+def _f_D_star_jac(params, neg_bvals, signal_D, S0, exp_D):
+    """Jacobian of `_f_D_star_residual` with respect to f and D_star.
+
+    The parameters are the same as for `_f_D_star_residual`.
+
+    Returns
+    -------
+    jac : array (len(bvals), 2)
+        The derivatives of the residual with respect to f and D_star.
+    """
+    f, D_star = params
+    exp_D_star = np.exp(neg_bvals * D_star)
+    return np.stack([S0 * (exp_D - exp_D_star),
+                     -f * S0 * neg_bvals * exp_D_star], axis=-1)
 
 
 def ivim_model_selector(gtab, fit_method='trr', **kwargs):
@@ -173,7 +254,8 @@ class IvimModelTRR(ReconstModel):
     def __init__(self, gtab, split_b_D=400.0, split_b_S0=200., bounds=None,
                  two_stage=True, tol=1e-15,
                  x_scale=[1000., 0.1, 0.001, 0.0001],
-                 gtol=1e-15, ftol=1e-15, eps=1e-15, maxiter=1000):
+                 gtol=1e-15, ftol=1e-15, eps=1e-15, maxiter=1000,
+                 noise_floor=None):
 
         r"""
         Initialize an IVIM model.
@@ -251,6 +333,13 @@ class IvimModelTRR(ReconstModel):
             Maximum number of iterations to perform.
             default : 1000
 
+        noise_floor : float, optional
+            Voxels whose mean signal at b==0 is below this value are
+            considered to contain only noise: they are not fit and get zero
+            parameters. If None, the noise floor is 1e-3 times the largest
+            mean b==0 signal of the voxels being fit.
+            default : None
+
         References
         ----------
         .. [1] Le Bihan, Denis, et al. "Separation of diffusion and perfusion
@@ -284,17 +373,24 @@ class IvimModelTRR(ReconstModel):
         self.options = {'gtol': gtol, 'ftol': ftol,
                         'eps': eps, 'maxiter': maxiter}
         self.x_scale = x_scale
+        self.noise_floor = noise_floor
 
         self.bounds = bounds or BOUNDS
 
-    @multi_voxel_fit
-    def fit(self, data):
+        # The bvalues used by the two linear fits only depend on gtab, hence
+        # their masks and least squares weights are computed once, the first
+        # time they are needed.
+        self._linear_fit_operators = {}
+
+    def fit(self, data, mask=None, batch_size=10000, parallel=False,
+            nbr_processes=None):
         """ Fit method of the IvimModelTRR class.
 
         The fitting takes place in the following steps: Linear fitting for D
         (bvals > `split_b_D` (default: 400)) and store S0_prime. Another linear
         fit for S0 (bvals < split_b_S0 (default: 200)). Estimate f using
-        1 - S0_prime/S0. Use non-linear least squares to fit D_star and f.
+        1 - S0_prime/S0. Use non-linear least squares, starting from the
+        linear estimates, to fit D_star and f keeping S0 and D fixed.
 
         We do a final non-linear fitting of all four parameters and select the
         set of parameters which make sense physically. The criteria for
@@ -303,57 +399,200 @@ class IvimModelTRR(ReconstModel):
         (default: 25%), we will reject the solution obtained from non-linear
         least squares fitting and consider only the linear fit.
 
+        The signals of the voxels are fit together in batches, as arrays of
+        shape (batch_size, len(bvals)): the linear fits are done for all the
+        voxels of a batch at once and only the non-linear least squares
+        problems are solved voxel by voxel. Voxels whose mean signal at b==0
+        is below `noise_floor` are not fit and get zero parameters.
 
         Parameters
         ----------
         data : array
-            The measured signal from one voxel. A multi voxel decorator
-            will be applied to this fit method to scale it and apply it
-            to multiple voxels.
+            The measured signal from one voxel or from multiple voxels. The
+            last dimension should contain the signal of each voxel.
 
+        mask : array, optional
+            A boolean array used to mark the coordinates in the data that
+            should be analyzed that has the shape data.shape[:-1]
+
+        batch_size : int, optional
+            The number of voxels fit together. Larger batches need less
+            overhead per voxel but more temporary memory.
+            default : 10000
+
+        parallel : bool, optional
+            If True, the batches are fit in parallel by a pool of processes.
+            In that case, the batches are made small enough for each process
+            to get several of them.
+            default : False
+
+        nbr_processes : int, optional
+            The number of subprocesses to use when `parallel` is True. If
+            None, the number of CPUs is used.
+            default : None
 
         Returns
         -------
         IvimFit object
+            A single fit holding the parameters of all the voxels, with
+            shape data.shape[:-1]. Unlike the MultiVoxelFit of models using
+            the multi_voxel_fit decorator, it has no `fit_array` nor `mask`
+            attributes: voxels outside of the mask have zero parameters.
+        """
+        if batch_size < 1:
+            raise ValueError("batch_size should be at least 1")
+        if mask is not None:
+            # Check for valid shape of the mask
+            if mask.shape != data.shape[:-1]:
+                raise ValueError("mask and data shape do not match")
+            mask = np.array(mask, dtype=bool, copy=False)
+        data_in_mask = np.reshape(data[mask], (-1, data.shape[-1]))
+
+        # Background voxels hold only noise: they are left out of the fit,
+        # like the voxels outside of the mask
+        S0_mean = np.mean(data_in_mask[:, self.gtab.b0s_mask], axis=-1)
+        noise_floor = self.noise_floor
+        if noise_floor is None:
+            S0_finite = S0_mean[np.isfinite(S0_mean)]
+            noise_floor = 1e-3 * S0_finite.max() if S0_finite.size else 0.
+        # Voxels with a nan signal are still fit, for the fit to warn
+        has_signal = ~(S0_mean < noise_floor)
+        data_to_fit = data_in_mask[has_signal]
+
+        n_voxels = data_to_fit.shape[0]
+
+        if parallel:
+            if nbr_processes is None:
+                try:
+                    nbr_processes = cpu_count()
+                except NotImplementedError:
+                    warnings.warn("Cannot determine number of cpus. "
+                                  "Fitting with parallel=False.")
+                    parallel = False
+            elif nbr_processes <= 0:
+                warnings.warn("Invalid number of processes (%d). "
+                              "Fitting with parallel=False." % nbr_processes)
+                parallel = False
+        if parallel:
+            # A few batches per process balance the load between processes
+            batch_size = int(min(batch_size,
+                                 np.ceil(n_voxels / (4. * nbr_processes))))
+            batch_size = max(batch_size, 1)
+
+        batches = [data_to_fit[start:start + batch_size]
+                   for start in range(0, n_voxels, batch_size)]
+        if parallel and len(batches) > 1:
+            pool = Pool(nbr_processes)
+            try:
+                results = pool.map(self._fit_voxels_recording_warnings,
+                                   batches)
+            finally:
+                pool.close()
+                pool.join()
+            params_batches = [params_batch for params_batch, _ in results]
+            # The warnings raised in the subprocesses are raised again here,
+            # once each, where they can be seen by the caller
+            caught = []
+            for _, caught_batch in results:
+                caught += [w for w in caught_batch if w not in caught]
+            for message, category in caught:
+                warnings.warn(message, category)
+        else:
+            params_batches = [self._fit_voxels(batch) for batch in batches]
+        params_in_mask = np.zeros((data_in_mask.shape[0], 4))
+        params_in_mask[has_signal] = np.concatenate([np.empty((0, 4))] +
+                                                    params_batches)
+
+        if mask is None:
+            ivim_params = params_in_mask.reshape(data.shape[:-1] + (4,))
+        else:
+            ivim_params = np.zeros(data.shape[:-1] + (4,))
+            ivim_params[mask, :] = params_in_mask
+
+        return IvimFit(self, ivim_params)
+
+    def _fit_voxels_recording_warnings(self, data):
+        """Fit the IVIM parameters of a set of voxels in a subprocess.
+
+        Parameters
+        ----------
+        data : array (N, len(bvals))
+            The measured signal of N voxels.
+
+        Returns
+        -------
+        params : array (N, 4)
+            The parameters S0, f, D_star and D of each voxel.
+
+        caught : list of tuples
+            The message and the category of each warning raised by the fit.
+        """
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            params = self._fit_voxels(data)
+        return params, [(str(w.message), w.category) for w in caught]
+
+    def _fit_voxels(self, data):
+        """Fit the IVIM parameters of a set of voxels.
+
+        Parameters
+        ----------
+        data : array (N, len(bvals))
+            The measured signal of N voxels.
+
+        Returns
+        -------
+        params : array (N, 4)
+            The parameters S0, f, D_star and D of each voxel.
         """
+        # Both linear fits use the log of the signal: take it only once
+        neg_log_data = -np.log(data)
+
         # Get S0_prime and D - parameters assuming a single exponential decay
         # for signals for bvals greater than `split_b_D`
         S0_prime, D = self.estimate_linear_fit(
-            data, self.split_b_D, less_than=False)
+            data, self.split_b_D, less_than=False, neg_log_data=neg_log_data)
 
         # Get S0 and D_star_prime - parameters assuming a single exponential
         # decay for for signals for bvals greater than `split_b_S0`.
 
-        S0, D_star_prime = self.estimate_linear_fit(data, self.split_b_S0,
-                                                    less_than=True)
+        S0, D_star_prime = self.estimate_linear_fit(
+            data, self.split_b_S0, less_than=True, neg_log_data=neg_log_data)
         # Estimate f
         f_guess = 1 - S0_prime / S0
 
+        # D is kept fixed while fitting f and D_star and it is the initial
+        # guess of the final fit: exp(-b * D) is computed once for both
+        exp_D = np.exp(np.outer(D, -self.gtab.bvals))
+
         # Fit f and D_star using leastsq.
-        params_f_D_star = [f_guess, D_star_prime]
-        f, D_star = self.estimate_f_D_star(params_f_D_star, data, S0, D)
-        params_linear = np.array([S0, f, D_star, D])
+        params_f_D_star = np.stack([f_guess, D_star_prime], axis=-1)
+        f, D_star = self.estimate_f_D_star(params_f_D_star, data, S0, D,
+                                           exp_D=exp_D)
+        params_linear = np.stack([S0, f, D_star, D], axis=-1)
         # Fit parameters again if two_stage flag is set.
         if self.two_stage:
-            params_two_stage = self._leastsq(data, params_linear)
-            bounds_violated = ~(np.all(params_two_stage >= self.bounds[0]) and
-                                (np.all(params_two_stage <= self.bounds[1])))
-            if bounds_violated:
+            params_two_stage = self._leastsq(data, params_linear, exp_D=exp_D)
+            bounds_violated = ~(
+                np.all(params_two_stage >= self.bounds[0], axis=-1) &
+                np.all(params_two_stage <= self.bounds[1], axis=-1))
+            if np.any(bounds_violated):
                 warningMsg = "Bounds are violated for leastsq fitting. "
                 warningMsg += "Returning parameters from linear fit"
                 warnings.warn(warningMsg, UserWarning)
-                return IvimFit(self, params_linear)
-            else:
-                return IvimFit(self, params_two_stage)
+                params_two_stage[bounds_violated] = \
+                    params_linear[bounds_violated]
+            return params_two_stage
         else:
-            return IvimFit(self, params_linear)
+            return params_linear
 
-    def estimate_linear_fit(self, data, split_b, less_than=True):
+    def estimate_linear_fit(self, data, split_b, less_than=True,
+                            neg_log_data=None):
         """Estimate a linear fit by taking log of data.
 
         Parameters
         ----------
-        data : array
+        data : array (..., len(bvals))
             An array containing the data to be fit
 
         split_b : float
@@ -362,78 +601,149 @@ class IvimModelTRR(ReconstModel):
         less_than : bool
             If True, splitting occurs for bvalues less than split_b
 
+        neg_log_data : array (..., len(bvals)), optional
+            The values of -log(data), if they were already computed.
+
         Returns
         -------
-        S0 : float
+        S0 : float or array
             The estimated S0 value. (intercept)
 
-        D : float
+        D : float or array
             The estimated value of D.
         """
-        if less_than:
-            bvals_split = self.gtab.bvals[self.gtab.bvals <= split_b]
-            D, neg_log_S0 = np.polyfit(bvals_split,
-                                       -np.log(data[self.gtab.bvals <=
-                                                    split_b]), 1)
+        bvals_mask, weights = self._linear_fit_operator(split_b, less_than)
+        if neg_log_data is None:
+            neg_log_data = -np.log(data[..., bvals_mask])
         else:
-            bvals_split = self.gtab.bvals[self.gtab.bvals >= split_b]
-            D, neg_log_S0 = np.polyfit(bvals_split,
-                                       -np.log(data[self.gtab.bvals >=
-                                                    split_b]), 1)
+            neg_log_data = neg_log_data[..., bvals_mask]
+        D, neg_log_S0 = np.dot(weights, neg_log_data.T)
 
         S0 = np.exp(-neg_log_S0)
         return S0, D
 
-    def estimate_f_D_star(self, params_f_D_star, data, S0, D):
+    def _linear_fit_operator(self, split_b, less_than):
+        """Get the bvalues mask and the least squares weights of a linear fit.
+
+        Parameters
+        ----------
+        split_b : float
+            The b value to split the data
+
+        less_than : bool
+            If True, splitting occurs for bvalues less than split_b
+
+        Returns
+        -------
+        bvals_mask : array
+            Boolean array selecting the bvalues used in the linear fit.
+
+        weights : array (2, bvals_mask.sum())
+            Weights giving the slope and the intercept of the least squares
+            line fit to a signal as weighted sums of the signal.
+
+        Raises
+        ------
+        ValueError
+            If there are less than two distinct bvalues in the split.
+        """
+        key = (split_b, less_than)
+        if key not in self._linear_fit_operators:
+            if less_than:
+                bvals_mask = self.gtab.bvals <= split_b
+            else:
+                bvals_mask = self.gtab.bvals >= split_b
+            bvals_split = self.gtab.bvals[bvals_mask]
+            if np.unique(bvals_split).size < 2:
+                e_s = "The linear fit for bvalues %s %s needs at least two "
+                e_s += "distinct bvalues, but the bvalues in this split are "
+                e_s += "%s"
+                raise ValueError(e_s % ("<=" if less_than else ">=", split_b,
+                                        bvals_split))
+            # Closed form of the least squares fit of a straight line
+            b_mean = bvals_split.mean()
+            b_centered = bvals_split - b_mean
+            slope = b_centered / np.dot(b_centered, b_centered)
+            intercept = 1. / bvals_split.size - b_mean * slope
+            self._linear_fit_operators[key] = (bvals_mask,
+                                               np.vstack([slope, intercept]))
+        return self._linear_fit_operators[key]
+
+    def estimate_f_D_star(self, params_f_D_star, data, S0, D, exp_D=None):
         """Estimate f and D_star using the values of all the other parameters
         obtained from a linear fit.
 
+        A bounded non-linear least squares fit of f and D_star is done for
+        each voxel, starting from the values given by the linear fits.
+
         Parameters
         ----------
-        params_f_D_star: array
+        params_f_D_star: array (..., 2)
             An array containing the value of f and D_star.
 
-        data : array
+        data : array (..., len(bvals))
             Array containing the actual signal values.
 
-        S0 : float
+        S0 : float or array
             The parameters S0 obtained from a linear fit.
 
-        D : float
+        D : float or array
             The parameters D obtained from a linear fit.
 
+        exp_D : array (..., len(bvals)), optional
+            The values of exp(-b * D), if they were already computed.
+
         Returns
         -------
-        f : float
+        f : float or array
            Perfusion fraction estimated from the fit.
-        D_star :
+        D_star : float or array
             The value of D_star estimated from the fit.
         """
-        gtol = self.options["gtol"]
-        ftol = self.options["ftol"]
-        xtol = self.tol
-        maxfev = self.options["maxiter"]
-
-        try:
-            res = least_squares(f_D_star_error,
-                                params_f_D_star,
-                                bounds=((0., 0.), (self.bounds[1][1],
-                                                   self.bounds[1][2])),
-                                args=(self.gtab, data, S0, D),
-                                ftol=ftol,
-                                xtol=xtol,
-                                gtol=gtol,
-                                max_nfev=maxfev)
-            f, D_star = res.x
-            return f, D_star
-        except ValueError:
+        x0 = np.atleast_2d(params_f_D_star)
+        data = np.atleast_2d(data)
+        S0 = np.broadcast_to(S0, data.shape[:1])
+        D = np.broadcast_to(D, data.shape[:1])
+        f_max, D_star_max = self.bounds[1][1], self.bounds[1][2]
+
+        # Voxels where the linear fit does not give a feasible initial guess
+        # keep the parameters of the linear fit
+        feasible = (np.all((x0 >= 0.) & (x0 <= (f_max, D_star_max)),
+                           axis=-1) &
+                    np.isfinite(S0) & np.isfinite(D) &
+                    np.all(np.isfinite(data), axis=-1))
+        if not np.all(feasible):
             warningMsg = "x0 obtained from linear fitting is not feasibile"
             warningMsg += " as initial guess for leastsq while estimating "
             warningMsg += "f and D_star. Using parameters from the "
             warningMsg += "linear fit."
             warnings.warn(warningMsg, UserWarning)
-            f, D_star = params_f_D_star
-            return f, D_star
+
+        # D is fixed while fitting f and D_star: its exponential is computed
+        # only once, for all the voxels
+        neg_bvals = -self.gtab.bvals
+        if exp_D is None:
+            exp_D = np.exp(np.outer(D, neg_bvals))
+        else:
+            exp_D = np.reshape(exp_D, data.shape)
+        signal_D = data - S0[:, None] * exp_D
+
+        # The solver options are the same for every voxel
+        options = dict(bounds=((0., 0.), (f_max, D_star_max)),
+                       ftol=self.options["ftol"], xtol=self.tol,
+                       gtol=self.options["gtol"],
+                       max_nfev=self.options["maxiter"],
+                       jac=_f_D_star_jac)
+        params = x0.astype(float)
+        for i in np.flatnonzero(feasible):
+            res = least_squares(_f_D_star_residual, params[i],
+                                args=(neg_bvals, signal_D[i], S0[i],
+                                      exp_D[i]),
+                                **options)
+            params[i] = res.x
+        f, D_star = np.moveaxis(
+            params.reshape(np.shape(params_f_D_star)), -1, 0)
+        return f, D_star
 
     def predict(self, ivim_params, gtab, S0=1.):
         """
@@ -459,53 +769,63 @@ class IvimModelTRR(ReconstModel):
         """
         return ivim_prediction(ivim_params, gtab)
 
-    def _leastsq(self, data, x0):
+    def _leastsq(self, data, x0, exp_D=None):
         """Use leastsq to find ivim_params
 
         Parameters
         ----------
-        data : array, (len(bvals))
-            An array containing the signal from a voxel.
-            If the data was a 3D image of 10x10x10 grid with 21 bvalues,
-            the multi_voxel decorator will run the single voxel fitting
-            on all the 1000 voxels to get the parameters in
-            IvimFit.model_paramters. The shape of the parameter array
-            will be (data[:-1], 4).
-
-        x0 : array
+        data : array, (..., len(bvals))
+            An array containing the signal from a voxel or from several
+            voxels. If the data was a 3D image of 10x10x10 grid with 21
+            bvalues, it holds the 1000 signals packed as an array of shape
+            (1000, 21) and the fitting is run on each of them to get an array
+            of parameters of shape (1000, 4).
+
+        x0 : array (..., 4)
             Initial guesses for the parameters S0, f, D_star and D
             calculated using a linear fitting.
 
+        exp_D : array (..., len(bvals)), optional
+            The values of exp(-b * D) for the initial guesses of D, if they
+            were already computed.
+
         Returns
         -------
-        x0 : array
+        x0 : array (..., 4)
             Estimates of the parameters S0, f, D_star and D.
         """
-        gtol = self.options["gtol"]
-        ftol = self.options["ftol"]
-        xtol = self.tol
-        maxfev = self.options["maxiter"]
-        bounds = self.bounds
-
-        try:
-            res = least_squares(_ivim_error,
-                                x0,
-                                bounds=bounds,
-                                ftol=ftol,
-                                xtol=xtol,
-                                gtol=gtol,
-                                max_nfev=maxfev,
-                                args=(self.gtab, data),
-                                x_scale=self.x_scale)
-            ivim_params = res.x
-            if np.all(np.isnan(ivim_params)):
-                return np.array([-1, -1, -1, -1])
-            return ivim_params
-        except ValueError:
+        x0 = np.asarray(x0, dtype=float)
+        shape = x0.shape
+        x0 = np.atleast_2d(x0)
+        data = np.atleast_2d(data)
+        if exp_D is not None:
+            exp_D = np.reshape(exp_D, data.shape)
+
+        # The solver options are the same for every voxel
+        options = dict(bounds=self.bounds, ftol=self.options["ftol"],
+                       xtol=self.tol, gtol=self.options["gtol"],
+                       max_nfev=self.options["maxiter"],
+                       x_scale=self.x_scale)
+        ivim_params = x0.copy()
+        feasible = True
+        for i in range(ivim_params.shape[0]):
+            if exp_D is None:
+                ivim_residual = IvimResidual(self.gtab.bvals, data[i])
+            else:
+                ivim_residual = IvimResidual(self.gtab.bvals, data[i],
+                                             D=x0[i, 3], exp_D=exp_D[i])
+            try:
+                res = least_squares(ivim_residual.residual, x0[i],
+                                    jac=ivim_residual.jacobian, **options)
+                ivim_params[i] = res.x
+            except ValueError:
+                feasible = False
+        if not feasible:
             warningMsg = "x0 is unfeasible for leastsq fitting."
             warningMsg += " Returning x0 values from the linear fit."
             warnings.warn(warningMsg, UserWarning)
-            return x0
+        ivim_params[np.all(np.isnan(ivim_params), axis=-1)] = -1
+        return ivim_params.reshape(shape)
 
 
 class IvimModelVP(ReconstModel):
@@ -858,23 +1178,29 @@ class IvimFit(object):
             model_params : array
                 The parameters of the model. In this case it is an
                 array of ivim parameters. If the fitting is done
-                for multi_voxel data, the multi_voxel decorator will
-                run the fitting on all the voxels and model_params
-                will be an array of the dimensions (data[:-1], 4),
-                i.e., there will be 4 parameters for each of the voxels.
+                for multi_voxel data with IvimModelTRR, all the voxels
+                are fit at once and model_params will be an array of
+                the dimensions (data[:-1], 4), i.e., there will be 4
+                parameters for each of the voxels. Indexing the fit
+                selects voxels, as for a MultiVoxelFit, and gives
+                another IvimFit holding their parameters. With
+                IvimModelVP, the multi_voxel decorator runs the fitting
+                on each voxel and gives one IvimFit per voxel.
         """
         self.model = model
         self.model_params = model_params
+        # Number of voxel dimensions, which an index may not exceed
+        self._ndim = np.ndim(model_params) - 1
 
     def __getitem__(self, index):
-        model_params = self.model_params
-        N = model_params.ndim
         if type(index) is not tuple:
-            index = (index,)
-        elif len(index) >= model_params.ndim:
+            return type(self)(self.model, self.model_params[index])
+        if len(index) > self._ndim:
             raise IndexError("IndexError: invalid index")
-        index = index + (slice(None),) * (N - len(index))
-        return type(self)(self.model, model_params[index])
+        # Only the voxel axes are indexed, also when the index holds an
+        # Ellipsis or new axes: the parameter axis is always kept whole
+        index = index + (slice(None),)
+        return type(self)(self.model, self.model_params[index])
 
     @property
     def S0_predicted(self):
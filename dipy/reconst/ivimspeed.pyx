@@ -0,0 +1,275 @@
+""" Optimized routines for fitting the IVIM model
+"""
+
+cimport cython
+
+import numpy as np
+cimport numpy as cnp
+
+from cython.parallel import prange
+from dipy.utils.omp cimport set_num_threads, restore_default_num_threads
+
+from libc.math cimport exp
+from libc.string cimport memcpy
+
+cdef extern from "math.h" nogil:
+    float expf(float x)
+
+ctypedef cython.floating floating
+
+# Coefficients of the degree 4 polynomial approximating exp over
+# [-log(2) / 2, log(2) / 2], fit at Chebyshev nodes
+DEF EXP_C0 = 1.0000000754953493
+DEF EXP_C1 = 0.9999622784754358
+DEF EXP_C2 = 0.4999886910881183
+DEF EXP_C3 = 0.1679216097465296
+DEF EXP_C4 = 0.041917529687951656
+DEF LOG2E = 1.4426950408889634
+DEF LN2 = 0.6931471805599453
+
+
+cdef inline double _fast_exp(double x) nogil:
+    """ Approximation of exp(x) within a relative error of 4e-6
+
+    x is written as k * log(2) + r, with k an integer and |r| <= log(2) / 2,
+    so that exp(x) = 2^k exp(r) where exp(r) is given by the polynomial and
+    2^k is built from its binary exponent.
+    """
+    cdef:
+        double y, r, two_k
+        cnp.int64_t k
+    if x < -708.:
+        return 0.
+    if x > 709.:
+        return exp(x)
+    y = x * LOG2E
+    k = <cnp.int64_t> (y + 0.5) if y >= 0 else <cnp.int64_t> (y - 0.5)
+    r = x - k * LN2
+    k = (k + 1023) << 52
+    memcpy(&two_k, &k, sizeof(double))
+    return two_k * (EXP_C0 + r * (EXP_C1 + r * (EXP_C2 + r * (EXP_C3 +
+                                                               r * EXP_C4))))
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _ivim_signal(const floating[:, :] p, const floating[:] b,
+                       floating[:, :] out, bint fast_exp) nogil:
+    cdef:
+        cnp.npy_intp i, j
+        floating S0, f, D_star, D
+    for i in prange(p.shape[0], schedule="static"):
+        S0 = p[i, 0]
+        f = p[i, 1]
+        D_star = p[i, 2]
+        D = p[i, 3]
+        for j in range(b.shape[0]):
+            if fast_exp:
+                out[i, j] = S0 * (f * _fast_exp(-b[j] * D_star) +
+                                  (1 - f) * _fast_exp(-b[j] * D))
+            elif floating is float:
+                out[i, j] = S0 * (f * expf(-b[j] * D_star) +
+                                  (1 - f) * expf(-b[j] * D))
+            else:
+                out[i, j] = S0 * (f * exp(-b[j] * D_star) +
+                                  (1 - f) * exp(-b[j] * D))
+
+
+def ivim_signal(params, bvals, num_threads=None, fast_exp=False):
+    """ Compute the IVIM signal of several voxels in a single pass
+
+    The bi-exponential signal is evaluated element by element, so that no
+    temporary arrays are created for the exponentials and their products.
+    The voxels are shared between OpenMP threads, if available.
+
+    Parameters
+    ----------
+    params : shape (N, 4) array
+        The IVIM parameters [S0, f, D_star, D] of N voxels. If they are
+        float32, the signal is computed and returned in float32, otherwise
+        in float64.
+    bvals : shape (M,) array
+        The b-values at which the signal is computed.
+    num_threads : int, optional
+        Number of threads. If None (default) then all available threads
+        will be used.
+    fast_exp : bool, optional
+        If True, the exponentials are computed with a polynomial
+        approximation within a relative error of 4e-6, which is faster
+        than the exponential of the C library. This is precise enough to
+        simulate or predict signals, but not to fit the model with tight
+        tolerances. Default: False.
+
+    Returns
+    -------
+    signal : shape (N, M) array
+        The IVIM signal of each voxel at each b-value.
+    """
+    cdef:
+        const float[:, :] p32
+        const float[:] b32
+        float[:, :] out32
+        const double[:, :] p64
+        const double[:] b64
+        double[:, :] out64
+        bint use_fast_exp = fast_exp
+    params = np.asarray(params)
+    if params.ndim != 2 or params.shape[1] != 4:
+        raise ValueError('params should contain 4 values per voxel')
+    dtype = np.float32 if params.dtype == np.float32 else np.float64
+    params = np.asarray(params, dtype=dtype)
+    bvals = np.asarray(bvals, dtype=dtype)
+    out = np.empty((params.shape[0], bvals.shape[0]), dtype=dtype)
+
+    set_num_threads(num_threads)
+
+    if dtype == np.float32:
+        p32 = params
+        b32 = bvals
+        out32 = out
+        with nogil:
+            _ivim_signal(p32, b32, out32, use_fast_exp)
+    else:
+        p64 = params
+        b64 = bvals
+        out64 = out
+        with nogil:
+            _ivim_signal(p64, b64, out64, use_fast_exp)
+
+    if num_threads is not None:
+        restore_default_num_threads()
+
+    return out
+
+
+cdef class IvimResidual:
+    """ Residual of the IVIM model in one voxel and its Jacobian
+
+    The exponentials exp(-b * D_star) and exp(-b * D) are kept from one call
+    to the next, so that the Jacobian evaluated at the point where the
+    residual was last computed does not compute them again.
+
+    Parameters
+    ----------
+    bvals : shape (M,) array
+        The b-values of the measurements.
+    signal : shape (M,) array
+        The measured signal of the voxel.
+    D : float, optional
+        A value of D for which exp(-b * D) is already known. It should be
+        given together with `exp_D`.
+    exp_D : shape (M,) array, optional
+        The values of exp(-b * D), used instead of computing them when the
+        residual is first evaluated at this value of D. It should be given
+        together with `D`.
+    """
+    cdef:
+        double[:] bvals
+        double[:] signal
+        double[:] exp_D_star
+        double[:] exp_D
+        double D_star
+        double D
+        bint cached_D_star
+        bint cached_D
+
+    def __init__(self, bvals, signal, D=None, exp_D=None):
+        self.bvals = np.array(bvals, dtype=float)
+        self.signal = np.array(signal, dtype=float)
+        if self.signal.shape[0] != self.bvals.shape[0]:
+            raise ValueError('signal and bvals should have the same length')
+        if (D is None) != (exp_D is None):
+            raise ValueError('D and exp_D should be given together')
+        self.exp_D_star = np.empty(self.bvals.shape[0])
+        self.cached_D_star = False
+        if exp_D is None:
+            self.exp_D = np.empty(self.bvals.shape[0])
+            self.cached_D = False
+        else:
+            self.exp_D = np.array(exp_D, dtype=float)
+            if self.exp_D.shape[0] != self.bvals.shape[0]:
+                raise ValueError('exp_D and bvals should have the same '
+                                 'length')
+            self.D = D
+            self.cached_D = True
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void _update(self, double D_star, double D) nogil:
+        cdef cnp.npy_intp j
+        if not (self.cached_D_star and D_star == self.D_star):
+            for j in range(self.bvals.shape[0]):
+                self.exp_D_star[j] = exp(-self.bvals[j] * D_star)
+            self.D_star = D_star
+            self.cached_D_star = True
+        if not (self.cached_D and D == self.D):
+            for j in range(self.bvals.shape[0]):
+                self.exp_D[j] = exp(-self.bvals[j] * D)
+            self.D = D
+            self.cached_D = True
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def residual(self, const double[:] params):
+        """ Difference between the measured and the estimated signal
+
+        Parameters
+        ----------
+        params : shape (4,) array
+            The IVIM parameters [S0, f, D_star, D].
+
+        Returns
+        -------
+        residual : shape (M,) array
+        """
+        cdef:
+            double[:] out
+            cnp.npy_intp j
+            double S0, f
+        if params.shape[0] != 4:
+            raise ValueError('params should contain 4 values')
+        S0 = params[0]
+        f = params[1]
+        residual = np.empty(self.bvals.shape[0])
+        out = residual
+        with nogil:
+            self._update(params[2], params[3])
+            for j in range(out.shape[0]):
+                out[j] = self.signal[j] - S0 * (f * self.exp_D_star[j] +
+                                                (1 - f) * self.exp_D[j])
+        return residual
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def jacobian(self, const double[:] params):
+        """ Derivatives of the residual with respect to the IVIM parameters
+
+        Parameters
+        ----------
+        params : shape (4,) array
+            The IVIM parameters [S0, f, D_star, D].
+
+        Returns
+        -------
+        jac : shape (M, 4) array
+            The derivatives with respect to S0, f, D_star and D.
+        """
+        cdef:
+            double[:, :] out
+            cnp.npy_intp j
+            double S0, f
+        if params.shape[0] != 4:
+            raise ValueError('params should contain 4 values')
+        S0 = params[0]
+        f = params[1]
+        jac = np.empty((self.bvals.shape[0], 4))
+        out = jac
+        with nogil:
+            self._update(params[2], params[3])
+            for j in range(out.shape[0]):
+                out[j, 0] = -(f * self.exp_D_star[j] +
+                              (1 - f) * self.exp_D[j])
+                out[j, 1] = S0 * (self.exp_D[j] - self.exp_D_star[j])
+                out[j, 2] = S0 * f * self.bvals[j] * self.exp_D_star[j]
+                out[j, 3] = S0 * (1 - f) * self.bvals[j] * self.exp_D[j]
+        return jac
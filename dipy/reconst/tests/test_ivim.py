@@ -18,8 +18,12 @@ from numpy.testing import (assert_array_equal, assert_array_almost_equal,
                            assert_, assert_equal)
 from dipy.testing import assert_greater_equal
 import pytest
+from scipy.optimize import least_squares
 
-from dipy.reconst.ivim import ivim_prediction, IvimModel
+from dipy.reconst.ivim import (ivim_prediction, IvimModel, _ivim_error,
+                               _ivim_jac, f_D_star_prediction,
+                               f_D_star_error, IvimFit)
+from dipy.reconst.ivimspeed import ivim_signal, IvimResidual
 from dipy.core.gradients import gradient_table, generate_bvecs
 from dipy.sims.voxel import multi_tensor
 
@@ -162,6 +166,72 @@ def test_multivoxel():
     assert_array_almost_equal(est_signal, data_multi)
 
 
+def test_fit_batches():
+    """
+    Test that fitting the voxels in several batches gives the same
+    parameters as fitting them all at once.
+    """
+    ivim_fit_multi = ivim_model_trr.fit(data_multi)
+    ivim_fit_batches = ivim_model_trr.fit(data_multi, batch_size=3)
+    assert_array_almost_equal(ivim_fit_batches.model_params,
+                              ivim_fit_multi.model_params)
+    assert_raises(ValueError, ivim_model_trr.fit, data_multi, batch_size=0)
+
+
+def test_fit_parallel():
+    """
+    Test that fitting the voxels in parallel gives the same parameters and
+    raises the same warnings as fitting them serially.
+    """
+    ivim_fit_multi = ivim_model_trr.fit(data_multi)
+    ivim_fit_parallel = ivim_model_trr.fit(data_multi, parallel=True,
+                                           nbr_processes=2)
+    assert_array_almost_equal(ivim_fit_parallel.model_params,
+                              ivim_fit_multi.model_params)
+
+    # The warnings raised while fitting in parallel reach the caller
+    rng = np.random.RandomState(0)
+    data_noisy = data_single + rng.normal(0, 0.1 * S0, (40, len(data_single)))
+    caught_messages = []
+    for parallel in [False, True]:
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            ivim_model_trr.fit(data_noisy, parallel=parallel,
+                               nbr_processes=2)
+        caught_messages.append(sorted(str(w.message) for w in caught))
+    assert_(len(caught_messages[0]) > 0)
+    assert_equal(caught_messages[1], caught_messages[0])
+
+
+def test_noise_floor():
+    """
+    Test that the voxels below the noise floor are not fit and get zero
+    parameters.
+    """
+    data_background = data_multi.copy()
+    data_background[0, 0, 0] = 1e-5 * data_multi[0, 0, 0]
+
+    # By default, the noise floor is relative to the largest signal of the
+    # voxels fit together
+    ivim_fit_background = ivim_model_trr.fit(data_background)
+    assert_array_equal(ivim_fit_background.model_params[0, 0, 0], 0)
+    assert_array_almost_equal(ivim_fit_background.model_params[1:],
+                              ivim_params_trr[1:])
+    # Hence the same voxel is fit when it is alone
+    params_alone = ivim_model_trr.fit(data_background[0, 0, 0]).model_params
+    assert_array_almost_equal(params_alone[0] / S0, 1e-5)
+    assert_array_almost_equal(params_alone[1:], params_trr[1:])
+
+    # An absolute noise floor does not depend on the other voxels
+    ivim_model_floor = IvimModel(gtab, fit_method='trr', noise_floor=2 * S0)
+    assert_array_equal(ivim_model_floor.fit(data_multi).model_params, 0)
+    assert_array_equal(ivim_model_floor.fit(data_single).model_params, 0)
+    ivim_model_no_floor = IvimModel(gtab, fit_method='trr', noise_floor=0)
+    assert_array_almost_equal(
+        ivim_model_no_floor.fit(data_background).model_params[0, 0, 0, 1:],
+        params_trr[1:])
+
+
 def test_ivim_errors():
     """
     Test if errors raised in the module are working correctly.
@@ -279,6 +349,109 @@ def test_predict():
                               data_multi)
 
 
+def test_ivim_signal():
+    """
+    Test the compiled IVIM signal against the bi-exponential expression,
+    for one voxel and for an array of voxels.
+    """
+    b = gtab.bvals
+    params = np.array([[S0, f, D_star, D],
+                       [2 * S0, 0.5 * f, 2 * D_star, 0.5 * D]])
+    expected = np.array([p[0] * (p[1] * np.exp(-b * p[2]) +
+                                 (1 - p[1]) * np.exp(-b * p[3]))
+                         for p in params])
+    assert_array_almost_equal(ivim_signal(params, b), expected)
+    for num_threads in [1, 2]:
+        assert_array_almost_equal(ivim_signal(params, b, num_threads),
+                                  expected)
+    # float32 parameters give a float32 signal
+    signal_32 = ivim_signal(params.astype(np.float32), b)
+    assert_equal(signal_32.dtype, np.float32)
+    assert_array_almost_equal(signal_32 / S0, expected / S0, decimal=5)
+    # The approximated exponential is within a relative error of 4e-6
+    for dtype in [np.float32, np.float64]:
+        signal_fast = ivim_signal(params.astype(dtype), b, fast_exp=True)
+        assert_array_almost_equal(signal_fast / expected, 1, decimal=5)
+    neg_x = np.linspace(0, 800, 1001)
+    exp_params = np.stack([np.ones_like(neg_x), np.zeros_like(neg_x),
+                           np.zeros_like(neg_x), neg_x], axis=-1)
+    exp_fast = ivim_signal(exp_params, [1.], fast_exp=True)[:, 0]
+    assert_(np.all(np.abs(exp_fast - np.exp(-neg_x)) <=
+                   4e-6 * np.exp(-neg_x) + 1e-300))
+    assert_array_almost_equal(ivim_prediction(params[0], gtab), expected[0])
+    multi_params = np.tile(params, (3, 1, 1))
+    assert_array_almost_equal(ivim_prediction(multi_params, gtab),
+                              np.tile(expected, (3, 1, 1)))
+    assert_raises(ValueError, ivim_signal, params[:, :3], b)
+    # The parameters are along the last dimension, not the first one
+    assert_raises(ValueError, ivim_prediction, params.T[..., None], gtab)
+    assert_raises(ValueError, ivim_prediction, np.ones((3, 5)), gtab)
+
+    # Read-only parameters, such as broadcast or memory-mapped arrays, can
+    # be used as well
+    params_read_only = np.broadcast_to(params[0], (3, 4))
+    assert_array_almost_equal(ivim_prediction(params_read_only, gtab),
+                              np.tile(expected[0], (3, 1)))
+    assert_array_almost_equal(
+        ivim_signal(params_read_only.astype(np.float32), b) / S0,
+        np.tile(expected[0], (3, 1)) / S0, decimal=5)
+    params_read_only = params.copy()
+    params_read_only.flags.writeable = False
+    assert_array_almost_equal(ivim_prediction(params_read_only, gtab),
+                              expected)
+    assert_array_almost_equal(
+        f_D_star_prediction(params_read_only[:, 1:3], gtab,
+                            params_read_only[:, 0], params_read_only[:, 3]),
+        expected)
+    assert_array_almost_equal(
+        IvimFit(ivim_model_trr, params_read_only).predict(gtab), expected)
+    ivim_residual = IvimResidual(b, expected[0])
+    assert_array_almost_equal(ivim_residual.residual(params_read_only[0]), 0)
+    assert_array_almost_equal(ivim_residual.jacobian(params_read_only[0]),
+                              _ivim_jac(params[0], gtab, expected[0]))
+
+    # f_D_star_prediction broadcasts S0 and D against the voxels
+    assert_array_almost_equal(f_D_star_prediction(params[0, 1:3], gtab,
+                                                  S0, D), expected[0])
+    assert_array_almost_equal(f_D_star_prediction(params[:, 1:3], gtab,
+                                                  params[:, 0],
+                                                  params[:, 3]), expected)
+
+
+def test_ivim_jac():
+    """
+    Test the analytical Jacobian of the IVIM error against central finite
+    differences.
+    """
+    params = np.array([S0, f, D_star, D])
+    jac = _ivim_jac(params, gtab, data_single)
+    assert_array_equal(jac.shape, (len(gtab.bvals), 4))
+    for i, step in enumerate(params * 1e-6):
+        dp = np.zeros(4)
+        dp[i] = step
+        num_jac = (_ivim_error(params + dp, gtab, data_single) -
+                   _ivim_error(params - dp, gtab, data_single)) / (2 * step)
+        assert_array_almost_equal(jac[:, i] / np.abs(jac[:, i]).max(),
+                                  num_jac / np.abs(jac[:, i]).max())
+
+    # The compiled residual gives the IVIM error, also after its
+    # exponentials were cached at another point
+    ivim_residual = IvimResidual(gtab.bvals, data_single)
+    for p in [params, 1.1 * params, 1.1 * params]:
+        assert_array_almost_equal(ivim_residual.residual(p),
+                                  _ivim_error(p, gtab, data_single))
+        assert_array_almost_equal(ivim_residual.jacobian(p),
+                                  _ivim_jac(p, gtab, data_single))
+    assert_raises(ValueError, IvimResidual, gtab.bvals, data_single[:-1])
+    exp_D = np.exp(-gtab.bvals * D)
+    assert_raises(ValueError, IvimResidual, gtab.bvals, data_single,
+                  exp_D=exp_D)
+    assert_raises(ValueError, IvimResidual, gtab.bvals, data_single, D=D)
+    assert_raises(ValueError, IvimResidual, gtab.bvals, data_single, D=D,
+                  exp_D=exp_D[:-1])
+    assert_raises(ValueError, ivim_residual.residual, params[:3])
+
+
 def test_fit_object():
     """
     Test the method of IvimFit class
@@ -297,6 +470,15 @@ def test_fit_object():
     assert_raises(IndexError, ivim_fit_multi.__getitem__, (-100, 0))
     assert_raises(IndexError, ivim_fit_multi.__getitem__, [-100, 0])
     assert_raises(IndexError, ivim_fit_multi.__getitem__, (1, 0, 0, 3, 4))
+    # Ellipsis and new axes only index the voxels, as for MultiVoxelFit
+    params_multi = ivim_fit_multi.model_params
+    ivim_fit_ellipsis = ivim_fit_multi[..., 0]
+    assert_array_equal(ivim_fit_ellipsis.shape, (2, 2))
+    assert_array_equal(ivim_fit_ellipsis.model_params, params_multi[..., 0, :])
+    assert_array_equal(ivim_fit_ellipsis.D, params_multi[..., 0, 3])
+    ivim_fit_new_axis = ivim_fit_multi[:, None]
+    assert_array_equal(ivim_fit_new_axis.shape, (2, 1, 2, 1))
+    assert_array_equal(ivim_fit_new_axis.model_params, params_multi[:, None])
     # Check if the get item returns the S0 value for voxel (1,0,0)
     assert_array_almost_equal(
         ivim_fit_multi.__getitem__((1, 0, 0)).model_params[0],
@@ -407,6 +589,29 @@ def test_estimate_linear_fit():
         (S0, D_star))
 
 
+def test_linear_fit_degenerate_split():
+    """
+    Test that a split of the bvalues with less than two distinct bvalues
+    raises an error when fitting, but not when building the model.
+    """
+    # No bvalue above split_b_D, or a single distinct one
+    for bvals_high in [[], [800., 800., 800.]]:
+        bvals = np.concatenate([[0., 10., 20., 50., 100., 200., 300.],
+                                bvals_high])
+        gtab_split = gradient_table(bvals, generate_bvecs(len(bvals)).T,
+                                    b0_threshold=0)
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", RuntimeWarning)
+            ivim_model_split = IvimModel(gtab_split, fit_method='trr')
+        assert_array_almost_equal(
+            ivim_model_split.predict(params_trr, gtab_split),
+            ivim_prediction(params_trr, gtab_split))
+        data_split = ivim_prediction(params_trr, gtab_split)
+        assert_raises(ValueError, ivim_model_split.estimate_linear_fit,
+                      data_split, ivim_model_split.split_b_D, False)
+        assert_raises(ValueError, ivim_model_split.fit, data_split)
+
+
 def test_estimate_f_D_star():
     """
     Test if the `estimate_f_D_star` returns the correct parameters after a
@@ -418,6 +623,27 @@ def test_estimate_f_D_star():
                                                                D),
                               (f, D_star))
 
+    # On noisy data, the estimates are those of a bounded least squares fit
+    # of each voxel started from the same initial guess
+    rng = np.random.RandomState(1234)
+    data_noisy = data_single + rng.normal(0, 0.03 * S0, (20, len(data_single)))
+    S0_noisy, D_star_noisy = ivim_model_trr.estimate_linear_fit(
+        data_noisy, ivim_model_trr.split_b_S0, less_than=True)
+    S0_prime, D_noisy = ivim_model_trr.estimate_linear_fit(
+        data_noisy, ivim_model_trr.split_b_D, less_than=False)
+    f_max, D_star_max = ivim_model_trr.bounds[1][1:3]
+    params_f_D = np.stack([np.clip(1 - S0_prime / S0_noisy, 0, f_max),
+                           np.clip(D_star_noisy, 0, D_star_max)], axis=-1)
+    f_est, D_star_est = ivim_model_trr.estimate_f_D_star(
+        params_f_D, data_noisy, S0_noisy, D_noisy)
+    for i in range(len(data_noisy)):
+        res = least_squares(f_D_star_error, params_f_D[i],
+                            bounds=((0., 0.), (f_max, D_star_max)),
+                            args=(gtab, data_noisy[i], S0_noisy[i],
+                                  D_noisy[i]),
+                            ftol=1e-15, xtol=1e-15, gtol=1e-15, max_nfev=1000)
+        assert_array_almost_equal([f_est[i], D_star_est[i]], res.x, decimal=5)
+
 
 def test_fit_one_stage():
     """